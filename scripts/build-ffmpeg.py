@@ -1,11 +1,21 @@
 import argparse
+import concurrent.futures
 import glob
 import os
 import platform
 import shutil
 import subprocess
 
-from cibuildpkg import Builder, Package, fetch, get_platform, log_group, run
+from cibuildpkg import (
+    Builder,
+    Package,
+    fetch_many,
+    get_platform,
+    install_system_packages,
+    log_group,
+    log_print,
+    run,
+)
 
 
 plat = platform.system()
@@ -40,21 +50,17 @@ library_group = [
 ]
 
 gnutls_group = [
-    Package(
-        name="unistring",
-        source_url="https://ftp.gnu.org/gnu/libunistring/libunistring-1.2.tar.gz",
-    ),
     Package(
         name="nettle",
         requires=["gmp"],
         source_url="https://ftp.gnu.org/gnu/nettle/nettle-3.9.1.tar.gz",
         build_arguments=["--disable-documentation"],
-        # build randomly fails with "*** missing separator.  Stop."
-        build_parallel=False,
+        # parallel build randomly fails with "*** missing separator.  Stop."
+        build_retry_serial=True,
     ),
     Package(
         name="gnutls",
-        requires=["nettle", "unistring"],
+        requires=["nettle"],
         source_url="https://www.gnupg.org/ftp/gcrypt/gnutls/v3.8/gnutls-3.8.1.tar.xz",
         build_arguments=[
             "--disable-cxx",
@@ -65,6 +71,7 @@ gnutls_group = [
             "--disable-tests",
             "--disable-tools",
             "--with-included-libtasn1",
+            "--with-included-unistring",
             "--without-p11-kit",
         ],
     ),
@@ -83,13 +90,15 @@ codec_group = [
             "-DENABLE_TESTS=0",
             "-DENABLE_TOOLS=0",
         ],
-        build_parallel=False,
+        # parallel build randomly fails
+        build_retry_serial=True,
     ),
     Package(
         name="dav1d",
         requires=["meson", "nasm", "ninja"],
         source_url="https://code.videolan.org/videolan/dav1d/-/archive/1.4.1/dav1d-1.4.1.tar.bz2",
         build_system="meson",
+        build_arguments=["-Denable_tests=false", "-Denable_tools=false"],
     ),
     Package(
         name="libsvtav1",
@@ -203,14 +212,112 @@ ffmpeg_package = Package(
     build_arguments=[],
 )
 
-
-def download_tars(use_gnutls, stage):
+# components kept when building a minimal FFmpeg
+ffmpeg_minimal_components = {
+    "bsf": [
+        "aac_adtstoasc",
+        "extract_extradata",
+        "h264_mp4toannexb",
+        "hevc_mp4toannexb",
+        "vp9_superframe",
+    ],
+    "decoder": [
+        "aac",
+        "av1",
+        "flac",
+        "h264",
+        "hevc",
+        "libdav1d",
+        "mjpeg",
+        "mp3",
+        "mpeg4",
+        "opus",
+        "pcm_f32le",
+        "pcm_s16le",
+        "png",
+        "vorbis",
+        "vp8",
+        "vp9",
+    ],
+    "demuxer": [
+        "aac",
+        "flac",
+        "image2",
+        "matroska",
+        "mov",
+        "mp3",
+        "mpegts",
+        "ogg",
+        "wav",
+    ],
+    "encoder": [
+        "aac",
+        "flac",
+        "libaom_av1",
+        "libmp3lame",
+        "libopenh264",
+        "libopus",
+        "libsvtav1",
+        "libvorbis",
+        "libvpx_vp8",
+        "libvpx_vp9",
+        "libx264",
+        "libx265",
+        "mjpeg",
+        "pcm_s16le",
+        "png",
+    ],
+    "filter": [
+        "abuffer",
+        "abuffersink",
+        "aformat",
+        "anull",
+        "aresample",
+        "buffer",
+        "buffersink",
+        "format",
+        "fps",
+        "null",
+        "scale",
+    ],
+    "muxer": [
+        "adts",
+        "flac",
+        "image2",
+        "matroska",
+        "mov",
+        "mp3",
+        "mp4",
+        "mpegts",
+        "null",
+        "ogg",
+        "wav",
+        "webm",
+    ],
+    "parser": [
+        "aac",
+        "av1",
+        "flac",
+        "h264",
+        "hevc",
+        "mjpeg",
+        "mpeg4video",
+        "mpegaudio",
+        "opus",
+        "png",
+        "vorbis",
+        "vp8",
+        "vp9",
+    ],
+    "protocol": ["file", "http", "https", "libsrt", "pipe", "tcp", "tls"],
+}
+
+
+def download_tars(builder, use_gnutls, stage):
     # Try to download all tars at the start.
     # If there is an curl error, do nothing, then try again in `main()`
 
-    local_libs = library_group
-    if use_gnutls:
-        local_libs += gnutls_group
+    local_libs = library_group + (gnutls_group if use_gnutls else [])
 
     if stage is None:
         the_packages = local_libs + codec_group
@@ -221,21 +328,20 @@ def download_tars(use_gnutls, stage):
     else:
         the_packages = []
 
+    # The downloads are independent and network-bound, so run them concurrently.
+    # Concurrency is capped to avoid tripping rate limits on the source servers.
+    downloads = []
     for package in the_packages:
-        tarball = os.path.join(
-            os.path.abspath("source"),
-            package.source_filename or package.source_url.split("/")[-1],
-        )
+        tarball = builder.tarball_path(package)
         if not os.path.exists(tarball):
-            try:
-                fetch(package.source_url, tarball)
-            except subprocess.CalledProcessError:
-                pass
+            downloads.append((package.source_url, tarball))
+    try:
+        fetch_many(downloads, max_workers=8)
+    except subprocess.CalledProcessError:
+        pass
 
 
 def main():
-    global library_group
-
     parser = argparse.ArgumentParser("build-ffmpeg")
     parser.add_argument("destination")
     parser.add_argument(
@@ -245,16 +351,26 @@ def main():
     )
     parser.add_argument("--enable-gpl", action="store_true")
     parser.add_argument("--disable-gpl", action="store_true")
+    parser.add_argument(
+        "--minimal",
+        action="store_true",
+        help="only build the FFmpeg components commonly used through PyAV",
+    )
 
     args = parser.parse_args()
 
     dest_dir = args.destination
     build_stage = None if args.stage is None else int(args.stage) - 1
     disable_gpl = args.disable_gpl
+    minimal = args.minimal
     del args
 
     output_dir = os.path.abspath("output")
 
+    # the libraries are stripped anyway, so do not spend time generating
+    # debugging information for FFmpeg unless it is wanted
+    debug = os.environ.get("DEBUG") == "1"
+
     # FFmpeg has native TLS backends for macOS and Windows
     use_gnutls = plat == "Linux"
 
@@ -268,34 +384,44 @@ def main():
     builder = Builder(dest_dir=dest_dir)
     builder.create_directories()
 
-    download_tars(use_gnutls, build_stage)
-
     # install packages
     available_tools = set()
     if plat == "Linux" and os.environ.get("CIBUILDWHEEL") == "1":
-        with log_group("install packages"):
-            run(
-                [
-                    "yum",
-                    "-y",
-                    "install",
-                    "gperf",
-                    "libuuid-devel",
-                    "libxcb-devel",
-                    "zlib-devel",
-                ]
-            )
+        # skip the package manager if a previous run installed everything
+        system_packages = ["gperf", "libuuid-devel", "libxcb-devel", "zlib-devel"]
+        if subprocess.run(
+            ["rpm", "-q"] + system_packages, stdout=subprocess.DEVNULL
+        ).returncode:
+            with log_group("install packages"):
+                install_system_packages(system_packages)
         available_tools.update(["gperf"])
+
+        # these tools are optional, they are only used if they can be installed
+        optional_tools = {"aria2c": "aria2", "ccache": "ccache", "pigz": "pigz"}
+        optional_packages = [
+            name for tool, name in optional_tools.items() if not shutil.which(tool)
+        ]
+        if optional_packages:
+            with log_group("install optional packages"):
+                for name in optional_packages:
+                    try:
+                        install_system_packages([name])
+                    except subprocess.CalledProcessError:
+                        pass
     elif plat == "Windows":
         available_tools.update(["gperf", "nasm"])
 
         # print tool locations
         print("PATH", os.environ["PATH"])
         for tool in ["gcc", "g++", "curl", "gperf", "ld", "nasm", "pkg-config"]:
-            run(["where", tool])
+            log_print(f"{tool}: {shutil.which(tool)}")
+
+    # download once the tools used for downloading are installed
+    download_tars(builder, use_gnutls, build_stage)
 
-    with log_group("install python packages"):
-        run(["pip", "install", "cmake", "meson", "ninja"])
+    if not all(shutil.which(tool) for tool in ["cmake", "meson", "ninja"]):
+        with log_group("install python packages"):
+            run(["pip", "install", "cmake", "meson", "ninja"])
 
     # build tools
     if "gperf" not in available_tools:
@@ -318,6 +444,7 @@ def main():
 
     ffmpeg_package.build_arguments = [
         "--disable-alsa",
+        "--enable-debug" if debug else "--disable-debug",
         "--disable-doc",
         "--disable-libtheora",
         "--disable-libfreetype",
@@ -367,27 +494,40 @@ def main():
         ffmpeg_package.build_arguments.extend(
             ["--enable-videotoolbox", "--extra-ldflags=-Wl,-ld_classic"]
         )
+    if minimal:
+        ffmpeg_package.build_arguments.append("--disable-everything")
+        for kind, names in ffmpeg_minimal_components.items():
+            ffmpeg_package.build_arguments.append(f"--enable-{kind}={','.join(names)}")
 
-    if use_gnutls:
-        library_group += gnutls_group
+    packages_stage0 = library_group + (gnutls_group if use_gnutls else []) + codec_group
+    # FFmpeg links against all the libraries, so its cached build must be
+    # invalidated whenever any of them changes
+    ffmpeg_package.requires = [p.name for p in packages_stage0 + [openh264]]
 
-    package_groups = [library_group + codec_group, [ffmpeg_package]]
+    package_groups = [packages_stage0, [ffmpeg_package]]
     if build_stage is not None:
-        packages = package_groups[build_stage]
-    else:
-        packages = [p for p_list in package_groups for p in p_list]
+        package_groups = [package_groups[build_stage]]
 
-    for package in packages:
-        if disable_gpl and package.gpl:
-            if package.name == "x264":
-                builder.build(openh264)
+    # build independent packages concurrently, except on Windows where
+    # parallel builds are known to hang or run out of memory
+    if plat == "Windows":
+        max_workers = 1
+    else:
+        max_workers = max(1, (os.cpu_count() or 1) // 2)
+
+    for package_group in package_groups:
+        packages = []
+        for package in package_group:
+            if disable_gpl and package.gpl:
+                if package.name == "x264":
+                    packages.append(openh264)
             else:
-                pass
-        else:
-            builder.build(package)
+                packages.append(package)
+        builder.build_packages(packages, max_workers=max_workers)
 
     if plat == "Windows" and (build_stage is None or build_stage == 1):
         # fix .lib files being installed in the wrong directory
+        moves = []
         for name in (
             "avcodec",
             "avdevice",
@@ -399,18 +539,16 @@ def main():
             "swscale",
         ):
             if os.path.exists(os.path.join(dest_dir, "bin", name + ".lib")):
-                shutil.move(
-                    os.path.join(dest_dir, "bin", name + ".lib"),
-                    os.path.join(dest_dir, "lib"),
+                moves.append(
+                    (
+                        os.path.join(dest_dir, "bin", name + ".lib"),
+                        os.path.join(dest_dir, "lib"),
+                    )
                 )
 
         # copy some libraries provided by mingw
-        mingw_bindir = os.path.dirname(
-            subprocess.run(["where", "gcc"], check=True, stdout=subprocess.PIPE)
-            .stdout.decode()
-            .splitlines()[0]
-            .strip()
-        )
+        mingw_bindir = os.path.dirname(shutil.which("gcc"))
+        copies = []
         for name in (
             "libgcc_s_seh-1.dll",
             "libiconv-2.dll",
@@ -418,7 +556,14 @@ def main():
             "libwinpthread-1.dll",
             "zlib1.dll",
         ):
-            shutil.copy(os.path.join(mingw_bindir, name), os.path.join(dest_dir, "bin"))
+            copies.append(
+                (os.path.join(mingw_bindir, name), os.path.join(dest_dir, "bin"))
+            )
+
+        # file operations are slow on Windows, so run them concurrently
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda paths: shutil.move(*paths), moves))
+            list(executor.map(lambda paths: shutil.copy(*paths), copies))
 
     # find libraries
     if plat == "Darwin":
@@ -430,7 +575,7 @@ def main():
 
     # strip libraries
     if plat == "Darwin":
-        run(["strip", "-S"] + libraries)
+        run(["strip", "-x"] + libraries)
         run(["otool", "-L"] + libraries)
     else:
         run(["strip", "-s"] + libraries)
@@ -438,7 +583,22 @@ def main():
     # build output tarball
     if build_stage is None or build_stage == 1:
         os.makedirs(output_dir, exist_ok=True)
-        run(["tar", "czvf", output_tarball, "-C", dest_dir, "bin", "include", "lib"])
+        # compress on all cores if pigz is available
+        compress_args = (
+            ["--use-compress-program=pigz", "-cvf"]
+            if shutil.which("pigz")
+            else ["czvf"]
+        )
+        run(
+            ["tar"]
+            + compress_args
+            + [output_tarball, "-C", dest_dir, "bin", "include", "lib"]
+        )
+
+    # drop cached build outputs which are stale, unless only part of the
+    # packages were built by this run
+    if build_stage is None:
+        builder.prune_cache()
 
 
 if __name__ == "__main__":
@@ -3,6 +3,8 @@
 from __future__ import annotations
 
 import contextlib
+import hashlib
+import json
 import os
 import platform
 import shutil
@@ -11,12 +13,113 @@ import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
 import time
+from concurrent import futures
 from dataclasses import dataclass, field, replace
 
 
 def fetch(url: str, path: str) -> None:
-    run(["curl", "-L", "-o", path, url])
+    """
+    Download `url` to `path`, using multiple connections if aria2 is available.
+
+    The file is downloaded under a temporary name and only moved into place
+    once complete, so an interrupted download never leaves a partial file.
+    """
+    # the same file may be fetched from several threads at once
+    partial_path = f"{path}.{threading.get_ident()}.part"
+    try:
+        if shutil.which("aria2c"):
+            # downloads run concurrently, so keep the per-file connection count low
+            run(
+                [
+                    "aria2c",
+                    "--allow-overwrite=true",
+                    "--auto-file-renaming=false",
+                    "--console-log-level=warn",
+                    "--max-connection-per-server=2",
+                    "--min-split-size=1M",
+                    "--split=2",
+                    "--dir=" + os.path.dirname(os.path.abspath(partial_path)),
+                    "--out=" + os.path.basename(partial_path),
+                    url,
+                ]
+            )
+        else:
+            run(["curl", "-L", "-o", partial_path, url])
+        os.replace(partial_path, path)
+    except BaseException:
+        # do not leave partial downloads behind in the persisted source cache
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(partial_path)
+        raise
+
+
+def fetch_many(downloads: list[tuple[str, str]], *, max_workers: int = 8) -> None:
+    """
+    Download each `(url, path)` pair, at most `max_workers` at a time.
+
+    With aria2 all the files are fetched by a single process, which reuses
+    its connections to each host. Files which were downloaded completely are
+    moved into place even if others failed, then `CalledProcessError` is
+    raised if any download failed.
+    """
+    if not downloads:
+        return
+
+    if not shutil.which("aria2c"):
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            jobs = [executor.submit(fetch, url, path) for url, path in downloads]
+        for job in jobs:
+            job.result()
+        return
+
+    partial_paths = {
+        path: f"{path}.{threading.get_ident()}.part" for _, path in downloads
+    }
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_file = os.path.join(temp_dir, "downloads.txt")
+            with open(input_file, "w") as fp:
+                for url, path in downloads:
+                    partial_path = os.path.abspath(partial_paths[path])
+                    fp.write(f"{url}\n")
+                    fp.write(f"  dir={os.path.dirname(partial_path)}\n")
+                    fp.write(f"  out={os.path.basename(partial_path)}\n")
+            run(
+                [
+                    "aria2c",
+                    "--allow-overwrite=true",
+                    "--auto-file-renaming=false",
+                    "--console-log-level=warn",
+                    "--input-file=" + input_file,
+                    f"--max-concurrent-downloads={max_workers}",
+                    "--max-connection-per-server=2",
+                    "--min-split-size=1M",
+                    "--split=2",
+                ]
+            )
+    finally:
+        # aria2 removes the control file of a download once it is complete
+        for path, partial_path in partial_paths.items():
+            if os.path.exists(partial_path) and not os.path.exists(
+                partial_path + ".aria2"
+            ):
+                os.replace(partial_path, path)
+            for name in (partial_path, partial_path + ".aria2"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(name)
+
+
+def sha256sum(path: str) -> str:
+    """
+    Compute the SHA-256 digest of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
 def get_platform() -> str:
@@ -38,19 +141,6 @@ def get_platform() -> str:
         raise Exception(f"Unsupported system {system}")
 
 
-@contextlib.contextmanager
-def chdir(path):
-    """
-    Changes to a directory and returns to the original directory at exit.
-    """
-    cwd = os.getcwd()
-    os.chdir(path)
-    try:
-        yield
-    finally:
-        os.chdir(cwd)
-
-
 @contextlib.contextmanager
 def log_group(title):
     """
@@ -71,22 +161,55 @@ def log_group(title):
         log_print(f"{start_color}{outcome}{end_color} {duration:.2f}s".rjust(78))
 
 
+@contextlib.contextmanager
+def log_buffered():
+    """
+    Collects the log output of the current thread and prints it in one piece
+    at exit, so that concurrent builds do not interleave their logs.
+    """
+    _log_state.buffer = []
+    try:
+        yield
+    finally:
+        lines = _log_state.buffer
+        _log_state.buffer = None
+        with _log_lock:
+            sys.stdout.write("".join(line + "\n" for line in lines))
+            sys.stdout.flush()
+
+
 def log_print(msg: str) -> None:
-    sys.stdout.write(msg + "\n")
-    sys.stdout.flush()
+    buffer = getattr(_log_state, "buffer", None)
+    if buffer is not None:
+        buffer.append(msg)
+        return
+    with _log_lock:
+        sys.stdout.write(msg + "\n")
+        sys.stdout.flush()
+
+
+_log_lock = threading.Lock()
+_log_state = threading.local()
 
 
-def make_args(*, parallel: bool) -> list[str]:
+def make_args(
+    *, parallel: bool, jobs: int | None = None, serialize_in_qemu: bool = True
+) -> list[str]:
     """
-    Arguments for GNU make.
+    Arguments for GNU make and Ninja.
     """
-    args = []
+    if not parallel:
+        jobs = 1
 
     # do not parallelize build when running in qemu
-    if parallel and platform.machine() not in ("aarch64", "ppc64le", "s390x"):
-        args.append("-j")
+    elif serialize_in_qemu and platform.machine() in ("aarch64", "ppc64le", "s390x"):
+        jobs = 1
 
-    return args
+    elif jobs is None:
+        jobs = os.cpu_count() or 1
+
+    # Ninja builds in parallel by default, so always pass the job count
+    return ["-j", str(jobs)]
 
 
 def prepend_env(env, name, new, separator=" "):
@@ -97,15 +220,42 @@ def prepend_env(env, name, new, separator=" "):
         env[name] = new
 
 
-def run(cmd, env=None):
+def run(cmd, env=None, cwd=None):
     log_print(f"- Running: {cmd}")
+    if getattr(_log_state, "buffer", None) is not None:
+        # capture all output so it ends up in the log buffer
+        result = subprocess.run(
+            cmd,
+            cwd=cwd,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+        log_print(result.stdout.rstrip("\n"))
+        result.check_returncode()
+        return
     try:
-        subprocess.run(cmd, check=True, env=env, stderr=subprocess.PIPE, text=True)
+        subprocess.run(
+            cmd, check=True, cwd=cwd, env=env, stderr=subprocess.PIPE, text=True
+        )
     except subprocess.CalledProcessError as e:
         print(f"stderr: {e.stderr}")
         raise e
 
 
+def install_system_packages(names: list[str]) -> None:
+    """
+    Install packages with the Linux package manager, skipping documentation
+    and weak dependencies.
+    """
+    if shutil.which("dnf"):
+        cmd = ["dnf", "-y", "install", "--nodocs", "--setopt=install_weak_deps=False"]
+    else:
+        cmd = ["yum", "-y", "install", "--setopt=tsflags=nodocs"]
+    run(cmd + names)
+
+
 def correct_configure(file_path):
     """
     Edit ffmpeg's configure file. Properly quote `$pkg_version` in function `test_pkg_config()`.
@@ -130,16 +280,52 @@ class Package:
     build_arguments: list[str] = field(default_factory=list)
     build_dir: str = "build"
     build_parallel: bool = True
+    build_retry_serial: bool = False
     requires: list[str] = field(default_factory=list)
     source_dir: str = ""
     source_filename: str = ""
     source_strip_components: int = 1
     gpl: bool = False
 
+    def cache_key(self, *extra: str) -> str:
+        """
+        Compute a key identifying the build outputs of this package.
+
+        The key covers the package definition, the platform, the compiler
+        and flags from the environment and any `extra` inputs such as digests,
+        the compiler version and the keys of the required packages.
+        """
+        inputs = [
+            self.name,
+            self.source_url,
+            self.build_system,
+            self.build_arguments,
+            self.source_dir,
+            get_platform(),
+            [
+                os.environ.get(var, "")
+                for var in (
+                    "ARCHFLAGS",
+                    "CC",
+                    "CFLAGS",
+                    "CXX",
+                    "CXXFLAGS",
+                    "LDFLAGS",
+                    "MACOSX_DEPLOYMENT_TARGET",
+                )
+            ],
+            list(extra),
+        ]
+        return hashlib.sha256(json.dumps(inputs).encode()).hexdigest()
+
     def __lt__(self, other):
         return self.name < other.name
 
 
+# where markers of installed packages live, relative to the prefix
+_INSTALLED_DIR = os.path.join("var", "lib", "cibuildpkg")
+
+
 class Builder:
     def __init__(self, dest_dir: str) -> None:
         self._builder_dest_dir = dest_dir + ".builder"
@@ -147,32 +333,134 @@ class Builder:
 
         self.build_dir = os.path.abspath("build")
         self.patch_dir = os.path.abspath("patches")
-        self.source_dir = os.path.abspath("source")
+
+        # directories persisted between runs
+        cache_root = os.path.abspath(os.environ.get("BUILD_CACHE_DIR", "."))
+        self.cache_dir = os.path.join(cache_root, "cache")
+        self.ccache_dir = os.path.join(cache_root, "ccache")
+        self.source_dir = os.path.join(cache_root, "source")
+
+        self._cache_files_used: set[str] = set()
+        self._source_files_used: set[str] = set()
+        self._install_lock = threading.Lock()
+        self._installed: dict[str, set[str]] = {}
+        self._worker = threading.local()
+        self._toolchain_id: str | None = None
+
+        # archives are written through temporary files, which are private
+        umask = os.umask(0)
+        os.umask(umask)
+        self._file_mode = 0o666 & ~umask
 
     def build(self, package: Package, *, for_builder: bool = False):
+        self._source_files_used.add(self.tarball_path(package))
+
         # if the package is already installed, do nothing
         installed_dir = os.path.join(
-            self._prefix(for_builder=for_builder), "var", "lib", "cibuildpkg"
+            self._prefix(for_builder=for_builder), _INSTALLED_DIR
         )
         installed_file = os.path.join(installed_dir, package.name)
-        if os.path.exists(installed_file):
+        installed_key = self._installed_key(package.name, for_builder=for_builder)
+        if installed_key is not None:
+            self._cache_files_used.add(self._cache_path(package.name, installed_key))
             return
 
         with log_group(f"build {package.name}"):
-            self._extract(package)
-            if package.name == "x265":
-                self._build_x265(package, for_builder=for_builder)
-            elif package.build_system == "cmake":
-                self._build_with_cmake(package, for_builder=for_builder)
-            elif package.build_system == "meson":
-                self._build_with_meson(package, for_builder=for_builder)
+            # if the installed files are cached, restore them instead of building
+            prefix = self._prefix(for_builder=for_builder)
+            key = self._cache_key(package, for_builder=for_builder)
+            cache_file = self._cache_path(package.name, key)
+            self._cache_files_used.add(cache_file)
+            if os.path.exists(cache_file):
+                log_print(f"- Restoring: {cache_file}")
+                with self._install_lock, tarfile.open(cache_file) as tar:
+                    tar.extractall(prefix)
             else:
-                self._build_with_autoconf(package, for_builder=for_builder)
-
-        # mark package as installed
-        os.makedirs(installed_dir, exist_ok=True)
-        with open(installed_file, "w") as fp:
-            fp.write("installed\n")
+                self._extract(package)
+                if package.name == "x265":
+                    self._build_x265(package, for_builder=for_builder)
+                elif package.build_system == "cmake":
+                    self._build_with_cmake(package, for_builder=for_builder)
+                elif package.build_system == "meson":
+                    self._build_with_meson(package, for_builder=for_builder)
+                else:
+                    self._build_with_autoconf(package, for_builder=for_builder)
+                self._save_cache(
+                    cache_file, prefix, self._installed.pop(package.name, set())
+                )
+
+            # mark package as installed, recording the key of its build outputs;
+            # hold the install lock so that no other install records the marker
+            with self._install_lock:
+                os.makedirs(installed_dir, exist_ok=True)
+                with open(installed_file, "w") as fp:
+                    fp.write(key + "\n")
+
+    def build_packages(self, packages: list[Package], *, max_workers: int) -> None:
+        """
+        Build packages concurrently, starting each package once the packages
+        it requires have been built.
+        """
+        names = {package.name for package in packages}
+        built: set[str] = set()
+        pending = list(packages)
+        running: dict[futures.Future, Package] = {}
+
+        # only buffer the logs if builds can actually run concurrently
+        max_workers = max(1, min(max_workers, len(packages)))
+        buffered = max_workers > 1
+
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                for package in list(pending):
+                    if len(running) == max_workers:
+                        break
+                    if all(r in built or r not in names for r in package.requires):
+                        # share the CPUs between the builds which can still run,
+                        # so the last builds get the cores left idle by others
+                        active_builds = min(max_workers, len(pending) + len(running))
+                        jobs = max(1, (os.cpu_count() or 1) // active_builds)
+
+                        pending.remove(package)
+                        future = executor.submit(
+                            self._build_in_worker, package, jobs=jobs, buffered=buffered
+                        )
+                        running[future] = package
+
+                assert running, "packages have circular requirements"
+                done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                    built.add(running.pop(future).name)
+
+    def prune_cache(self) -> None:
+        """
+        Delete the cached build outputs and source tarballs which were not
+        used by this run.
+        """
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".tar.gz") and path not in self._cache_files_used:
+                log_print(f"- Removing: {path}")
+                os.remove(path)
+
+        for name in os.listdir(self.source_dir):
+            path = os.path.join(self.source_dir, name)
+            if (
+                name not in ("config.guess", "config.sub")
+                and path not in self._source_files_used
+            ):
+                log_print(f"- Removing: {path}")
+                os.remove(path)
+
+    def tarball_path(self, package: Package) -> str:
+        """
+        Return the path where the source tarball of a package is stored.
+        """
+        return os.path.join(
+            self.source_dir,
+            package.source_filename or package.source_url.split("/")[-1],
+        )
 
     def create_directories(self) -> None:
         # print debugging information
@@ -186,9 +474,13 @@ class Builder:
             shutil.rmtree(self.build_dir)
 
         # create directories
-        for d in [self.build_dir, self.source_dir]:
+        for d in [self.build_dir, self.cache_dir, self.source_dir]:
             os.makedirs(d, exist_ok=True)
 
+        # keep the compiler cache with the other persisted directories
+        os.environ.setdefault("CCACHE_DIR", self.ccache_dir)
+        os.environ.setdefault("CCACHE_MAXSIZE", "500M")
+
         # add tools to PATH
         prepend_env(
             os.environ,
@@ -236,6 +528,16 @@ class Builder:
             elif platform.system() == "Windows":
                 configure_args += ["--target=x86_64-win64-gcc"]
 
+        # cache compiler output across builds
+        if shutil.which("ccache"):
+            default_cc = "clang" if platform.system() == "Darwin" else "gcc"
+            default_cxx = "clang++" if platform.system() == "Darwin" else "g++"
+            env["CC"] = "ccache " + env.get("CC", default_cc)
+            env["CXX"] = "ccache " + env.get("CXX", default_cxx)
+            if package.name == "ffmpeg":
+                # FFmpeg's configure ignores CC and CXX from the environment
+                configure_args += ["--cc=" + env["CC"], "--cxx=" + env["CXX"]]
+
         if package.name == "ffmpeg" and platform.system() == "Windows":
             correct_configure(os.path.join(package_source_path, "configure"))
             prepend_env(env, "LDFLAGS", "-LC:/PROGRA~1/OpenSSL/lib")
@@ -248,20 +550,26 @@ class Builder:
         
         # build package
         os.makedirs(package_build_path, exist_ok=True)
-        with chdir(package_build_path):
-            run(
-                [
-                    "sh",
-                    self._mangle_path(os.path.join(package_source_path, "configure")),
-                ]
-                + configure_args
-                + package.build_arguments,
-                env=env,
-            )
-            run(
-                ["make"] + make_args(parallel=package.build_parallel) + ["V=1"], env=env
-            )
-            run(["make", "install"], env=env)
+        run(
+            [
+                "sh",
+                self._mangle_path(os.path.join(package_source_path, "configure")),
+            ]
+            + configure_args
+            + package.build_arguments,
+            env=env,
+            cwd=package_build_path,
+        )
+        self._run_build(
+            ["make", "V=1"], package=package, env=env, cwd=package_build_path
+        )
+        self._install(
+            ["make", "install"],
+            package=package,
+            for_builder=for_builder,
+            env=env,
+            cwd=package_build_path,
+        )
 
     def _build_with_cmake(self, package: Package, for_builder: bool) -> None:
         assert package.build_system == "cmake"
@@ -273,30 +581,46 @@ class Builder:
         env = self._environment(for_builder=for_builder)
         prefix = self._prefix(for_builder=for_builder)
         cmake_args = [
-            "-GUnix Makefiles",
+            "-GNinja",
             "-DBUILD_SHARED_LIBS=1",
             "-DCMAKE_INSTALL_LIBDIR=lib",
             "-DCMAKE_INSTALL_PREFIX=" + prefix,
         ]
         if platform.system() == "Darwin":
             cmake_args.append("-DCMAKE_INSTALL_NAME_DIR=" + os.path.join(prefix, "lib"))
+        if not any(
+            arg.startswith("-DCMAKE_BUILD_TYPE=") for arg in package.build_arguments
+        ):
+            cmake_args.append("-DCMAKE_BUILD_TYPE=Release")
+        if shutil.which("ccache"):
+            cmake_args += [
+                "-DCMAKE_C_COMPILER_LAUNCHER=ccache",
+                "-DCMAKE_CXX_COMPILER_LAUNCHER=ccache",
+            ]
 
         if package.name == "srt" and platform.system() == "Linux":
-            run(["yum", "-y", "install", "openssl-devel"])
+            install_system_packages(["openssl-devel"])
 
         # build package
         os.makedirs(package_build_path, exist_ok=True)
-        with chdir(package_build_path):
-            run(
-                ["cmake", package_source_path] + cmake_args + package.build_arguments,
-                env=env,
-            )
-            run(
-                ["cmake", "--build", ".", "--verbose"]
-                + make_args(parallel=package.build_parallel),
-                env=env,
-            )
-            run(["cmake", "--install", "."], env=env)
+        run(
+            ["cmake", package_source_path] + cmake_args + package.build_arguments,
+            env=env,
+            cwd=package_build_path,
+        )
+        self._run_build(
+            ["cmake", "--build", ".", "--verbose"],
+            package=package,
+            env=env,
+            cwd=package_build_path,
+        )
+        self._install(
+            ["cmake", "--install", "."],
+            package=package,
+            for_builder=for_builder,
+            env=env,
+            cwd=package_build_path,
+        )
 
     def _build_with_meson(self, package: Package, for_builder: bool) -> None:
         assert package.build_system == "meson"
@@ -308,16 +632,30 @@ class Builder:
         env = self._environment(for_builder=for_builder)
         prefix = self._prefix(for_builder=for_builder)
         meson_args = ["--libdir=lib", "--prefix=" + prefix]
+        if not any(arg.startswith("--buildtype") for arg in package.build_arguments):
+            meson_args.append("--buildtype=release")
 
         # build package
         os.makedirs(package_build_path, exist_ok=True)
-        with chdir(package_build_path):
-            run(
-                ["meson", package_source_path] + meson_args + package.build_arguments,
-                env=env,
-            )
-            run(["ninja", "--verbose"], env=env)
-            run(["ninja", "install"], env=env)
+        run(
+            ["meson", package_source_path] + meson_args + package.build_arguments,
+            env=env,
+            cwd=package_build_path,
+        )
+        self._run_build(
+            ["ninja", "--verbose"],
+            package=package,
+            env=env,
+            cwd=package_build_path,
+            serialize_in_qemu=False,
+        )
+        self._install(
+            ["ninja", "install"],
+            package=package,
+            for_builder=for_builder,
+            env=env,
+            cwd=package_build_path,
+        )
 
     def _build_x265(self, package: Package, for_builder: bool) -> None:
         assert package.name == "x265"
@@ -370,11 +708,12 @@ class Builder:
         )
         self._build_with_cmake(package=x265_10bits, for_builder=for_builder)
 
-        package_path = os.path.join(self.build_dir, package.name)
-        with chdir(os.path.join(package_path, x265_12bits.build_dir)):
-            os.rename("libx265.a", "libx265-12bits.a")
-        with chdir(os.path.join(package_path, x265_10bits.build_dir)):
-            os.rename("libx265.a", "libx265-10bits.a")
+        for variant, suffix in ((x265_12bits, "12bits"), (x265_10bits, "10bits")):
+            variant_path = os.path.join(package_path, variant.build_dir)
+            os.rename(
+                os.path.join(variant_path, "libx265.a"),
+                os.path.join(variant_path, f"libx265-{suffix}.a"),
+            )
 
         package.build_arguments = [
             "-DEXTRA_LIB=x265-10bits.a;x265-12bits.a",
@@ -384,6 +723,44 @@ class Builder:
         ]
         self._build_with_cmake(package=package, for_builder=for_builder)
 
+    def _cache_key(self, package: Package, *, for_builder: bool) -> str:
+        patch = os.path.join(self.patch_dir, package.name + ".patch")
+        requires_keys = [
+            f"{name}={self._installed_key(name, for_builder=for_builder)}"
+            for name in sorted(package.requires)
+        ]
+        return package.cache_key(
+            self._prefix(for_builder=for_builder),
+            sha256sum(self._download(package)),
+            sha256sum(patch) if os.path.exists(patch) else "",
+            # the build commands are generated here, so changes to them must
+            # invalidate the cache too
+            sha256sum(__file__),
+            self._toolchain(),
+            *requires_keys,
+        )
+
+    def _toolchain(self) -> str:
+        """
+        Identify the C compiler by its version output.
+        """
+        if self._toolchain_id is None:
+            default_cc = "clang" if platform.system() == "Darwin" else "gcc"
+            cc = os.environ.get("CC", default_cc).split()[-1]
+            self._toolchain_id = subprocess.run(
+                [cc, "--version"], check=True, stdout=subprocess.PIPE, text=True
+            ).stdout
+        return self._toolchain_id
+
+    def _cache_path(self, name: str, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{name}-{key}.tar.gz")
+
+    def _download(self, package: Package) -> str:
+        tarball = self.tarball_path(package)
+        if not os.path.exists(tarball):
+            fetch(package.source_url, tarball)
+        return tarball
+
     def _extract(self, package: Package) -> None:
         assert package.source_strip_components in (
             0,
@@ -391,38 +768,42 @@ class Builder:
         ), "source_strip_components must be 0 or 1"
         path = os.path.join(self.build_dir, package.name)
         patch = os.path.join(self.patch_dir, package.name + ".patch")
-        tarball = os.path.join(
-            self.source_dir,
-            package.source_filename or package.source_url.split("/")[-1],
-        )
+        tarball = self._download(package)
 
-        # download tarball
-        if not os.path.exists(tarball):
-            fetch(package.source_url, tarball)
+        with tempfile.TemporaryDirectory(dir=self.build_dir) as temp_dir:
+            # extract archive, reading the compressed stream only once
+            with tarfile.open(tarball) as tar:
+                tar.extractall(temp_dir)
 
-        with tarfile.open(tarball) as tar:
             # determine common prefix to strip
             if package.source_strip_components:
-                prefixes = set()
-                for name in tar.getnames():
-                    prefixes.add(name.split("/")[0])
+                prefixes = os.listdir(temp_dir)
                 assert (
                     len(prefixes) == 1
                 ), "cannot strip path components, multiple prefixes found"
-                prefix = list(prefixes)[0]
+                prefix = prefixes[0]
             else:
                 prefix = ""
 
-            # extract archive
-            with tempfile.TemporaryDirectory(dir=self.build_dir) as temp_dir:
-                tar.extractall(temp_dir)
-                temp_subdir = os.path.join(temp_dir, prefix)
-                shutil.move(temp_subdir, path)
+            temp_subdir = os.path.join(temp_dir, prefix)
+            shutil.move(temp_subdir, path)
 
         # apply patch
         if os.path.exists(patch):
             run(["patch", "-d", path, "-i", patch, "-p1"])
 
+    def _installed_key(self, name: str, *, for_builder: bool) -> str | None:
+        """
+        Return the cache key recorded when a package was installed, if it is.
+        """
+        installed_file = os.path.join(
+            self._prefix(for_builder=for_builder), _INSTALLED_DIR, name
+        )
+        if not os.path.exists(installed_file):
+            return None
+        with open(installed_file) as fp:
+            return fp.read().strip()
+
     def _environment(self, *, for_builder: bool) -> dict[str, str]:
         env = os.environ.copy()
 
@@ -447,6 +828,96 @@ class Builder:
 
         return env
 
+    def _build_in_worker(self, package: Package, *, jobs: int, buffered: bool) -> None:
+        self._worker.jobs = jobs
+        try:
+            with log_buffered() if buffered else contextlib.nullcontext():
+                self.build(package)
+        finally:
+            self._worker.jobs = None
+
+    def _install(
+        self, cmd: list[str], *, package: Package, for_builder: bool, env, cwd
+    ) -> None:
+        """
+        Run the install step, recording which files it adds or modifies.
+
+        Installs are serialized so that concurrent builds do not write to the
+        prefix at the same time and each package's files can be told apart.
+        """
+        prefix = self._prefix(for_builder=for_builder)
+        with self._install_lock:
+            installed_before = self._snapshot(prefix)
+            run(cmd, env=env, cwd=cwd)
+            installed_after = self._snapshot(prefix)
+            self._installed.setdefault(package.name, set()).update(
+                name
+                for name, stat in installed_after.items()
+                if installed_before.get(name) != stat
+            )
+
+    def _run_build(
+        self,
+        cmd: list[str],
+        *,
+        package: Package,
+        env,
+        cwd,
+        serialize_in_qemu: bool = True,
+    ) -> None:
+        """
+        Run the build step, retrying serially if a flaky parallel build fails.
+        """
+        try:
+            run(
+                cmd
+                + make_args(
+                    parallel=package.build_parallel,
+                    jobs=getattr(self._worker, "jobs", None),
+                    serialize_in_qemu=serialize_in_qemu,
+                ),
+                env=env,
+                cwd=cwd,
+            )
+        except subprocess.CalledProcessError:
+            if not (package.build_parallel and package.build_retry_serial):
+                raise
+            log_print("- Parallel build failed, retrying serially")
+            run(cmd + make_args(parallel=False), env=env, cwd=cwd)
+
+    def _save_cache(self, cache_file: str, prefix: str, installed: set[str]) -> None:
+        """
+        Archive the files of `prefix` which were installed by a package.
+        """
+        with tempfile.NamedTemporaryFile(dir=self.cache_dir, delete=False) as fp:
+            with tarfile.open(fileobj=fp, mode="w:gz", compresslevel=1) as tar:
+                for name in sorted(installed):
+                    if name.startswith(_INSTALLED_DIR + os.sep):
+                        continue
+                    tar.add(os.path.join(prefix, name), name, recursive=False)
+        os.chmod(fp.name, self._file_mode)
+        os.replace(fp.name, cache_file)
+
+    def _snapshot(self, prefix: str) -> dict[str, tuple]:
+        """
+        Record the size and modification time of every file in `prefix`,
+        except the markers of installed packages.
+        """
+        snapshot = {}
+        for root, dirs, files in os.walk(prefix):
+            if os.path.relpath(root, prefix) == _INSTALLED_DIR:
+                dirs[:] = []
+                continue
+            links = [d for d in dirs if os.path.islink(os.path.join(root, d))]
+            for name in files + links:
+                path = os.path.join(root, name)
+                stat = os.lstat(path)
+                snapshot[os.path.relpath(path, prefix)] = (
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                )
+        return snapshot
+
     def _mangle_path(self, path: str) -> str:
         if platform.system() == "Windows":
             path = path.replace(os.path.sep, "/")